@@ -9,9 +9,12 @@
 # Some inspiration was taken from the dogbone add-in developed by Peter
 # Ludikar, Gary Singer, Patrick Rainsberry, David Liu, and Casey Rogers.
 
+from __future__ import annotations
+
 import adsk.core
 import adsk.fusion
 
+from . import application
 from . import commands
 from . import options
 from . import ui
@@ -20,20 +23,42 @@ from . import geometry
 # Global variable to hold the add-in (created in run(), destroyed in stop())
 addIn = None
 
-
-def createBaseFeature(parentComponent, bRepBody, name):
+# All features created by this add-in get names starting with this prefix.
+# Checking the name is much cheaper than a round trip into the attribute
+# store, so tools walking the timeline can recognize our features without
+# touching anything but the name.
+FEATURE_NAME_PREFIX = 'fingerjoint '
+
+# Collection used to pass tool bodies to cut features. Allocating a collection
+# through the API is not free, so we create one lazily and reuse it.
+toolBodyCollection = None
+
+def getToolBodyCollection(toolBodies):
+    global toolBodyCollection
+    if toolBodyCollection is None:
+        toolBodyCollection = adsk.core.ObjectCollection.create()
+    toolBodyCollection.clear()
+    add = toolBodyCollection.add
+    for toolBody in toolBodies:
+        add(toolBody)
+    return toolBodyCollection
+
+
+def createBaseFeature(parentComponent, bRepBodies, name):
+    # Adding all bodies within one edit keeps this down to a single timeline
+    # commit, which is much cheaper than one commit per body. We return the
+    # persisted bodies (not the feature), so callers can refer to them
+    # without assumptions about the order in which the feature lists them.
     feature = parentComponent.features.baseFeatures.add()
     feature.startEdit()
-    parentComponent.bRepBodies.add(bRepBody, feature)
+    addBody = parentComponent.bRepBodies.add
+    featureBodies = [addBody(bRepBody, feature) for bRepBody in bRepBodies]
     feature.name = name
     feature.finishEdit()
-    return feature
+    return featureBodies
 
-def createCutFeature(parentComponent, targetBody, toolBodyFeature):
-    toolBodies = adsk.core.ObjectCollection.create()
-    assert(toolBodyFeature.bodies.count == 1)
-    toolBodies.add(toolBodyFeature.bodies.item(0))
-    cutInput = parentComponent.features.combineFeatures.createInput(targetBody, toolBodies)
+def createCutFeature(parentComponent, targetBody, toolBodies):
+    cutInput = parentComponent.features.combineFeatures.createInput(targetBody, getToolBodyCollection(toolBodies))
     cutInput.operation = adsk.fusion.FeatureOperations.CutFeatureOperation
     cutInput.isNewComponent = False
     cutFeature = parentComponent.features.combineFeatures.add(cutInput)
@@ -41,6 +66,8 @@ def createCutFeature(parentComponent, targetBody, toolBodyFeature):
 
 
 class CreateFingerJointCommand(commands.RunningCommandBase):
+    __slots__ = ('ui', 'last_used_inputs')
+
     def __init__(self, args: adsk.core.CommandCreatedEventArgs):
         super(CreateFingerJointCommand, self).__init__(args)
         defaults = options.FingerJointFeatureInput()
@@ -72,34 +99,38 @@ class CreateFingerJointCommand(commands.RunningCommandBase):
     def doExecute(self):
         inputs = self.ui.createInputs()
         self.last_used_inputs = inputs
-        toolBodies = geometry.createToolBodies(inputs)
-        if toolBodies == True:
-            # No cut is neccessary (bodies do not overlap).
-            return True
-        elif toolBodies == False:
+        try:
+            toolBodies = geometry.createToolBodies(inputs)
+        except geometry.InvalidInputsError:
             # No cut is possible (e.g., because of invalid inputs).
             return False
-        else:
-            self.createCustomFeature(inputs, *toolBodies)
+        if toolBodies is None:
+            # No cut is neccessary (bodies do not overlap).
             return True
+        self.createCustomFeature(inputs, *toolBodies)
+        return True
 
-    def createCustomFeature(self, inputs, toolBody0, toolBody1):
-        app = adsk.core.Application.get()
+    def createCustomFeature(self, inputs, toolBodies0, toolBodies1):
+        app = application.get()
         activeComponent = app.activeProduct.activeComponent
         design = activeComponent.parentDesign
 
-        # Temporarily switch to parametric design
+        # Temporarily switch to parametric design. Flipping the design type is
+        # expensive (it can replay the full timeline), so we skip the switch if
+        # the design is already parametric, which is the common case.
         previousDesignType = design.designType
-        design.designType = adsk.fusion.DesignTypes.ParametricDesignType
+        if previousDesignType != adsk.fusion.DesignTypes.ParametricDesignType:
+            design.designType = adsk.fusion.DesignTypes.ParametricDesignType
 
         # We will later group all created features into a custom feature.
         # For that reason, we have to remember the first and last feature that is part of this group.
-        tool0Feature = createBaseFeature(activeComponent, toolBody0, "tool0")
-        createCutFeature(activeComponent, inputs.body0, tool0Feature)
-        tool1Feature = createBaseFeature(activeComponent, toolBody1, "tool1")
-        createCutFeature(activeComponent, inputs.body1, tool1Feature)
+        featureBodies = createBaseFeature(activeComponent, toolBodies0 + toolBodies1, FEATURE_NAME_PREFIX + "tools")
+        assert(len(featureBodies) == len(toolBodies0) + len(toolBodies1))
+        createCutFeature(activeComponent, inputs.body0, featureBodies[:len(toolBodies0)])
+        createCutFeature(activeComponent, inputs.body1, featureBodies[len(toolBodies0):])
 
-        design.designType = previousDesignType
+        if previousDesignType != adsk.fusion.DesignTypes.ParametricDesignType:
+            design.designType = previousDesignType
 
     def onDestroy(self, args: adsk.core.CommandEventArgs):
         super(CreateFingerJointCommand, self).onDestroy(args)
@@ -108,6 +139,8 @@ class CreateFingerJointCommand(commands.RunningCommandBase):
 
 
 class FingerJointAddIn(commands.AddIn):
+    __slots__ = ()
+
     COMMAND_ID = 'fpFingerJoints'
     FEATURE_NAME = 'Finger Joint'
     RESOURCE_FOLDER = 'resources/ui/command_button'
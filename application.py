@@ -0,0 +1,16 @@
+import adsk.core
+
+# The application object is the same for the lifetime of the add-in, so we
+# fetch it once instead of paying for a lookup through the API at every call
+# site. The active product is deliberately not cached because it changes
+# whenever the user switches documents.
+_app = None
+
+def get():
+    global _app
+    if _app is None:
+        _app = adsk.core.Application.get()
+    return _app
+
+def userInterface():
+    return get().userInterface
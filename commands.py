@@ -1,24 +1,44 @@
+import weakref
+
 import adsk.core
 import adsk.fusion
 
+from . import application
 from . import ui
 
 # Keep track of all currently running commands in a global set, so their
 # callback handlers are not GC'd.
 running_commands = set()
 
-def makeForwardingHandler(handler_cls, callback):
-    class ForwardingHandler(handler_cls):
-        def __init__(self, callback):
-            super().__init__()
-            self.callback = callback
+# Creating a new handler class for every handler instance is wasteful, so we
+# create one forwarding class per event handler type and reuse it.
+forwarding_handler_classes = {}
 
-        def notify(self, args):
-            try:
-                self.callback(args)
-            except:
-                ui.reportError('Callback method failed', True)
-    return ForwardingHandler(callback)
+def makeForwardingHandler(handler_cls, callback):
+    forwarding_cls = forwarding_handler_classes.get(handler_cls)
+    if forwarding_cls is None:
+        class ForwardingHandler(handler_cls):
+            def __init__(self, callback):
+                super().__init__()
+                # Only keep a weak reference to the callback. The handlers are
+                # wrappers around C++ objects that the cyclic garbage collector
+                # cannot look into, so a strong reference back to the command
+                # would leak the command and all its handlers. The commands
+                # stay alive through running_commands instead.
+                self.callback = weakref.WeakMethod(callback)
+
+            # reportError is bound as a default argument so the frequent
+            # events (mouse moves, validation) do not resolve two module
+            # attributes on every dispatch.
+            def notify(self, args, _reportError=ui.reportError):
+                try:
+                    callback = self.callback()
+                    if callback is not None:
+                        callback(args)
+                except:
+                    _reportError('Callback method failed', True)
+        forwarding_handler_classes[handler_cls] = forwarding_cls = ForwardingHandler
+    return forwarding_cls(callback)
 
 
 class RunningCommandBase(object):
@@ -29,35 +49,32 @@ class RunningCommandBase(object):
     To use this class, inherit from it an override the events.
     """
 
+    # Instances live as long as their command dialog is open, so we use
+    # __slots__ to keep them small and attribute access fast. Derived classes
+    # have to declare their own attributes in __slots__ as well.
+    __slots__ = ('_handlers', '__weakref__')
+
+    # Events of the command that should be forwarded to methods of this class.
+    EVENTS = (
+        ('inputChanged', adsk.core.InputChangedEventHandler, 'onInputChanged'),
+        ('selectionEvent', adsk.core.SelectionEventHandler, 'onSelectionEvent'),
+        ('validateInputs', adsk.core.ValidateInputsEventHandler, 'onValidate'),
+        ('execute', adsk.core.CommandEventHandler, 'onExecute'),
+        ('executePreview', adsk.core.CommandEventHandler, 'onExecutePreview'),
+        ('destroy', adsk.core.CommandEventHandler, 'onDestroy'),
+    )
+
     def __init__(self, args):
         running_commands.add(self)
 
     def onCreate(self, args):
-        cmd = adsk.core.Command.cast(args.command)            
-
-        self._inputChangedHandler = makeForwardingHandler(
-            adsk.core.InputChangedEventHandler, self.onInputChanged)
-        cmd.inputChanged.add(self._inputChangedHandler)
-
-        self._selectionHandler = makeForwardingHandler(
-            adsk.core.SelectionEventHandler, self.onSelectionEvent)
-        cmd.selectionEvent.add(self._selectionHandler)
-        
-        self._validateHandler = makeForwardingHandler(
-            adsk.core.ValidateInputsEventHandler, self.onValidate)
-        cmd.validateInputs.add(self._validateHandler)
-        
-        self._executeHandler = makeForwardingHandler(
-            adsk.core.CommandEventHandler, self.onExecute)
-        cmd.execute.add(self._executeHandler)
-
-        self._executePreviewHandler = makeForwardingHandler(
-            adsk.core.CommandEventHandler, self.onExecutePreview)
-        cmd.executePreview.add(self._executePreviewHandler)
-
-        self._destroyHandler = makeForwardingHandler(
-            adsk.core.CommandEventHandler, self.onDestroy)
-        cmd.destroy.add(self._destroyHandler)
+        cmd = adsk.core.Command.cast(args.command)
+        # Keep references to the handlers so they are not GC'd.
+        self._handlers = []
+        for eventName, handlerCls, methodName in self.EVENTS:
+            handler = makeForwardingHandler(handlerCls, getattr(self, methodName))
+            getattr(cmd, eventName).add(handler)
+            self._handlers.append(handler)
 
     def onCreated(self, args):
         pass
@@ -78,10 +95,14 @@ class RunningCommandBase(object):
         pass
 
     def onDestroy(self, args):
-        running_commands.remove(self)
+        running_commands.discard(self)
 
 
 class AddIn(object):
+    # __weakref__ is needed because the forwarding handler only keeps a weak
+    # reference to _onCreate (and through it to this instance).
+    __slots__ = ('fusionUI', '_panel', '_createHandler', '__weakref__')
+
     # Defaults that are None have to be overridden in derived classes.
     COMMAND_ID = None
     FEATURE_NAME = None
@@ -92,13 +113,19 @@ class AddIn(object):
     RUNNING_CREATE_COMMAND_CLASS = None
 
     def __init__(self):
-        fusion = adsk.core.Application.get()
-        self.fusionUI = fusion.userInterface
+        self.fusionUI = application.userInterface()
+        # The toolbar panel never changes, so we look it up only once.
+        self._panel = None
 
         # Add handler for creating the feature.
         self._createHandler = makeForwardingHandler(
             adsk.core.CommandCreatedEventHandler, self._onCreate)
 
+    def _getPanel(self):
+        if self._panel is None:
+            self._panel = self.fusionUI.allToolbarPanels.itemById(self.PANEL_NAME)
+        return self._panel
+
     def _onCreate(self, args):
         running_command = self.RUNNING_CREATE_COMMAND_CLASS(args)
         running_command.onCreate(args)
@@ -111,10 +138,9 @@ class AddIn(object):
 
     def addToUI(self):
         # If there are existing instances of the button, clean them up first.
-        try:
-            self.removeFromUI()
-        except:
-            pass
+        # removeFromUI only deletes what actually exists, so this is safe even
+        # on the first run.
+        self.removeFromUI()
 
         # Create a command for creating the feature.
         createCommandDefinition = self.fusionUI.commandDefinitions.addButtonDefinition(
@@ -122,8 +148,7 @@ class AddIn(object):
         createCommandDefinition.commandCreated.add(self._createHandler)
 
         # Add a button to the UI.
-        panel = self.fusionUI.allToolbarPanels.itemById(self.PANEL_NAME)
-        buttonControl = panel.controls.addCommand(createCommandDefinition)
+        buttonControl = self._getPanel().controls.addCommand(createCommandDefinition)
         buttonControl.isPromotedByDefault = True
         buttonControl.isPromoted = True
 
@@ -132,7 +157,6 @@ class AddIn(object):
         if createCommandDefinition:
             createCommandDefinition.deleteMe()
 
-        panel = self.fusionUI.allToolbarPanels.itemById(self.PANEL_NAME)
-        buttonControl = panel.controls.itemById(self._getCreateButtonID())
+        buttonControl = self._getPanel().controls.itemById(self._getCreateButtonID())
         if buttonControl:
             buttonControl.deleteMe()
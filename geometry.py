@@ -1,154 +1,273 @@
+import math
+import operator
+
 import adsk.core
 import adsk.fusion
 
+from . import application
 from .options import DynamicSizeType, PlacementType
 
 
+class InvalidInputsError(Exception):
+    """Raised when no tool bodies can be created for the given inputs."""
+
+
+# The temporary BRep manager is a singleton, so we pay for the lookup through
+# the API only once instead of once per call.
+_temporaryBRepManager = None
+
+def getTemporaryBRepManager():
+    global _temporaryBRepManager
+    if _temporaryBRepManager is None:
+        _temporaryBRepManager = adsk.fusion.TemporaryBRepManager.get()
+    return _temporaryBRepManager
+
+
 def findOrthogonalUnitVectors(z):
-    v = adsk.core.Vector3D.create(1, 0, 0)
-    if v.isParallelTo(z):
-        v = adsk.core.Vector3D.create(0, 1, 0)
-    x = z.crossProduct(v)
-    x.normalize()
-    y = z.crossProduct(x)
-    y.normalize()
-    return x, y
+    # Doing the arithmetic on plain floats keeps the API traffic down to one
+    # call to read the components of z and two calls to create the results
+    # (instead of one call per cross product, normalization and parallelity
+    # test).
+    zx, zy, zz = z.asArray()
+    # Crossing z with the axis along its smallest component avoids the
+    # degenerate case of (near-)parallel vectors.
+    if abs(zx) <= abs(zy) and abs(zx) <= abs(zz):
+        ax, ay, az = 1.0, 0.0, 0.0
+    elif abs(zy) <= abs(zz):
+        ax, ay, az = 0.0, 1.0, 0.0
+    else:
+        ax, ay, az = 0.0, 0.0, 1.0
+    # x = z cross axis
+    xx = zy * az - zz * ay
+    xy = zz * ax - zx * az
+    xz = zx * ay - zy * ax
+    norm = math.sqrt(xx * xx + xy * xy + xz * xz)
+    xx, xy, xz = xx / norm, xy / norm, xz / norm
+    # y = z cross x
+    yx = zy * xz - zz * xy
+    yy = zz * xx - zx * xz
+    yz = zx * xy - zy * xx
+    norm = math.sqrt(yx * yx + yy * yy + yz * yz)
+    return (adsk.core.Vector3D.create(xx, xy, xz),
+            adsk.core.Vector3D.create(yx / norm, yy / norm, yz / norm))
+
+
+# Accessors for the end points of the entity types that can define the joint
+# direction. Using a dispatch table instead of isinstance chains keeps the
+# type checks on the wrapped API types to a single dict lookup and makes
+# supporting additional entity types a one-line addition.
+DIRECTION_END_POINTS = {
+    adsk.fusion.BRepEdge: (operator.attrgetter('startVertex.geometry'),
+                           operator.attrgetter('endVertex.geometry')),
+    adsk.fusion.SketchLine: (operator.attrgetter('startSketchPoint.worldGeometry'),
+                             operator.attrgetter('endSketchPoint.worldGeometry')),
+}
+
+def getDirectionEndPoints(direction):
+    for cls in type(direction).__mro__:
+        endPointAccessors = DIRECTION_END_POINTS.get(cls)
+        if endPointAccessors is not None:
+            getStartPoint, getEndPoint = endPointAccessors
+            return getStartPoint(direction), getEndPoint(direction)
+    assert(False)
 
 
 class CoordinateSystem(object):
+    """A coordinate system where the z axis is in the given direction and the
+    bounding box of the given body is centered around this axis.
+
+    The class can create boxes that are aligned with its axes but expressed in
+    global coordinates. This way, the tool bodies can be built directly in
+    global space and no body ever has to be transformed between coordinate
+    systems."""
+
+    __slots__ = ('_origin', '_xAxis', '_yAxis', '_zAxis', '_xAxisVector',
+                 '_yAxisVector', 'localWidthX', 'localWidthY', 'localHeight')
+
     def __init__(self, direction, body):
-        """Creates a coordinate system where the z axis is in the given direction
-        and the bounding box of the given body is centered around this axis"""
         # Define the axes of the coordinate system.
-        if isinstance(direction, adsk.fusion.BRepEdge):
-            origin = direction.startVertex.geometry
-            zAxis = origin.vectorTo(direction.endVertex.geometry)
-        else:
-            assert(isinstance(direction, adsk.fusion.SketchLine))
-            origin = direction.startSketchPoint.worldGeometry
-            zAxis = origin.vectorTo(direction.endSketchPoint.worldGeometry)
+        origin, endPoint = getDirectionEndPoints(direction)
+        zAxis = origin.vectorTo(endPoint)
         zAxis.normalize()
         xAxis, yAxis = findOrthogonalUnitVectors(zAxis)
 
-        # Get a preliminary transformation (axis are correct but origin will be shifted later).
-        preliminaryTransform = adsk.core.Matrix3D.create()
-        preliminaryTransform.setWithCoordinateSystem(origin, xAxis, yAxis, zAxis)
-        inversePreliminaryTransform = preliminaryTransform.copy()
-        inversePreliminaryTransform.invert()
-
-        # Find center of body's bounding box in local coordinates.
-        temporaryBRepManager = adsk.fusion.TemporaryBRepManager.get()
-        body_local = temporaryBRepManager.copy(body)
-        temporaryBRepManager.transform(body_local, inversePreliminaryTransform)
-        bb = body_local.boundingBox
-        minx, miny, minz = bb.minPoint.asArray()
-        maxx, maxy, maxz = bb.maxPoint.asArray()
-        cx = (minx + maxx) / 2
-        cy = (miny + maxy) / 2
-
-        # Create the coordinate system with the correct origin
-        origin = adsk.core.Point3D.create(cx, cy, minz)
-        origin.transformBy(preliminaryTransform)
-        self.transform = adsk.core.Matrix3D.create()
-        self.transform.setWithCoordinateSystem(origin, xAxis, yAxis, zAxis)
-        self.inverseTransform = self.transform.copy()
-        self.inverseTransform.invert()
-
-    def transformToLocalCoordinates(self, body):
-        temporaryBRepManager = adsk.fusion.TemporaryBRepManager.get()
-        temporaryBRepManager.transform(body, self.inverseTransform)
-
-    def transformToGlobalCoordinates(self, body):
-        temporaryBRepManager = adsk.fusion.TemporaryBRepManager.get()
-        temporaryBRepManager.transform(body, self.transform)
-
-
-def createBox(x, y, z, length, width, height):
-    centerPoint = adsk.core.Point3D.create(x, y, z)
-    lengthDirection = adsk.core.Vector3D.create(1, 0, 0)
-    widthDirection = adsk.core.Vector3D.create(0, 1, 0)
-    return adsk.core.OrientedBoundingBox3D.create(centerPoint, lengthDirection, widthDirection, length, width, height)
-
-
-def createToolBody(body, slices, inputs, debug=False):
-    bb = body.boundingBox
-    minx, miny, minz = bb.minPoint.asArray()
-    maxx, maxy, maxz = bb.maxPoint.asArray()
-    cx = (minx + maxx) / 2
-    cy = (miny + maxy) / 2
+        # Measure the extents of the body along the axes. The oriented
+        # bounding box is exact (it is computed on the original body, not on
+        # an axis-aligned approximation), so this replaces copying the body
+        # and transforming it into local coordinates just to read its
+        # bounding box. Since yAxis = zAxis x xAxis, the height of the box is
+        # measured along the z axis.
+        measureManager = application.get().measureManager
+        boundingBox = measureManager.getOrientedBoundingBox(body, xAxis, yAxis)
+        self.localWidthX = boundingBox.length
+        self.localWidthY = boundingBox.width
+        self.localHeight = boundingBox.height
+
+        # Place the origin so the body is centered in x and y and starts at 0
+        # in z: that is half the height below the center of the bounding box.
+        zx, zy, zz = zAxis.asArray()
+        cx, cy, cz = boundingBox.centerPoint.asArray()
+        halfHeight = self.localHeight / 2
+
+        # Keep the frame as plain floats (plus the axis vectors for creating
+        # boxes), so the methods below can stay off the API where possible.
+        self._origin = (cx - halfHeight*zx, cy - halfHeight*zy, cz - halfHeight*zz)
+        self._xAxis = xAxis.asArray()
+        self._yAxis = yAxis.asArray()
+        self._zAxis = (zx, zy, zz)
+        self._xAxisVector = xAxis
+        self._yAxisVector = yAxis
+
+    def createLocalBox(self, z, length, width, height):
+        """Creates a box centered on the z axis of this coordinate system
+        (at the given local z height) but expressed in global coordinates."""
+        ox, oy, oz = self._origin
+        zx, zy, zz = self._zAxis
+        centerPoint = adsk.core.Point3D.create(ox + z*zx, oy + z*zy, oz + z*zz)
+        return adsk.core.OrientedBoundingBox3D.create(
+            centerPoint, self._xAxisVector, self._yAxisVector, length, width, height)
+
+    def createLocalScaleTransform(self, scaleFactor):
+        """Creates a global transformation that scales by the given factor in
+        the x and y directions of this coordinate system."""
+        x, y, z = self._xAxis, self._yAxis, self._zAxis
+        o = self._origin
+        # The rotational part is s*(X X^T + Y Y^T) + Z Z^T, the translation
+        # moves the origin of the frame back onto itself.
+        rotation = [[scaleFactor * (x[i]*x[j] + y[i]*y[j]) + z[i]*z[j]
+                     for j in range(3)] for i in range(3)]
+        translation = [o[i] - sum(rotation[i][j] * o[j] for j in range(3))
+                       for i in range(3)]
+        transform = adsk.core.Matrix3D.create()
+        transform.setWithArray([
+            rotation[0][0], rotation[0][1], rotation[0][2], translation[0],
+            rotation[1][0], rotation[1][1], rotation[1][2], translation[1],
+            rotation[2][0], rotation[2][1], rotation[2][2], translation[2],
+            0, 0, 0, 1])
+        return transform
+
+
+def createToolBody(body, slicesPerTool, inputs, coordinateSystem, debug=False):
+    """Creates the bodies of several cutting tools in one pass.
+
+    The slice boxes are created directly in global space through the given
+    coordinate system, so neither the body nor the tool bodies ever have to be
+    transformed between coordinate systems. slicesPerTool contains one
+    (sliceStarts, sliceThickness) pair per tool; the result contains one list
+    of bodies per tool."""
     # To avoid issues with rounding, we add 1cm of slack.
     slack = 1
-    length = maxx - minx + slack
-    width = maxy - miny + slack
-
-    temporaryBRepManager = adsk.fusion.TemporaryBRepManager.get()
-    targetBody = None
-    for (sliceCenterStart, sliceThickness) in slices:
-        box = createBox(cx, cy, minz + sliceCenterStart + sliceThickness/2, length, width, sliceThickness)
-        sliceBody = temporaryBRepManager.createBox(box)
-        if targetBody is None:
-            targetBody = sliceBody
-        else:
-            temporaryBRepManager.booleanOperation(targetBody, sliceBody, adsk.fusion.BooleanTypes.UnionBooleanType)
+    length = coordinateSystem.localWidthX + slack
+    width = coordinateSystem.localWidthY + slack
+
+    temporaryBRepManager = getTemporaryBRepManager()
+    # Bind the methods used in the loop to local names, so the loop does not
+    # repeat the attribute lookups for every slice.
+    createBRepBox = temporaryBRepManager.createBox
+    booleanOperation = temporaryBRepManager.booleanOperation
+    intersectionType = adsk.fusion.BooleanTypes.IntersectionBooleanType
+    createLocalBox = coordinateSystem.createLocalBox
+    # The slices are disjoint along the z axis, so instead of unioning all
+    # slice boxes into one tool body (which makes the boolean operations more
+    # and more expensive as the body grows), we intersect each box with the
+    # body individually and keep the results as separate bodies. Boxes that
+    # miss the body completely are dropped.
+    toolBodies = []
+    for (sliceStarts, sliceThickness) in slicesPerTool:
+        sliceBodies = []
+        for sliceCenterStart in sliceStarts:
+            box = createLocalBox(sliceCenterStart + sliceThickness/2, length, width, sliceThickness)
+            sliceBody = createBRepBox(box)
+            booleanOperation(sliceBody, body, intersectionType)
+            if sliceBody.faces.count > 0:
+                sliceBodies.append(sliceBody)
+        toolBodies.append(sliceBodies)
 
     if debug:
-        app = adsk.core.Application.get()
-        root = app.activeProduct.rootComponent
-        feature = root.features.baseFeatures.add()
-        feature.startEdit()
-        root.bRepBodies.add(targetBody, feature)
-        feature.finishEdit()
+        # A single edit block keeps this down to one timeline commit.
+        root = application.get().activeProduct.rootComponent
         feature = root.features.baseFeatures.add()
         feature.startEdit()
+        for sliceBodies in toolBodies:
+            for sliceBody in sliceBodies:
+                root.bRepBodies.add(sliceBody, feature)
         root.bRepBodies.add(body, feature)
         feature.finishEdit()
 
-    temporaryBRepManager.booleanOperation(targetBody, body, adsk.fusion.BooleanTypes.IntersectionBooleanType)
-
-    # Scale up tool body, so its length and width are increased by the gap we want to leave to the other part.
-    # The correct way to do so would be to compute an offset. Scaling works if the intersection is a square but
-    # will otherwise have a too large gap on one side. Note that we have to scale in x and y direction with the
-    # same factor because the axes may not be aligned with the axis of the intersection.
+    # Scale up the tool bodies, so their length and width are increased by the gap we want to leave to the
+    # other part. The correct way to do so would be to compute an offset. Scaling works if the intersection
+    # is a square but will otherwise have a too large gap on one side. Note that we have to scale in x and y
+    # direction with the same factor because the axes may not be aligned with the axis of the intersection.
     gapToPart = inputs.gapToPart.value
-    scaleFactorX = (length + 2*gapToPart) / length
-    scaleFactorY = (width + 2*gapToPart) / width
-    scaleFactor = max(scaleFactorX, scaleFactorY)
-    transform = adsk.core.Matrix3D.create()
-    transform.setWithArray([scaleFactor, 0,           0, 0,
-                            0,           scaleFactor, 0, 0,
-                            0,           0,           1, 0,
-                            0,           0,           0, 1])
-    temporaryBRepManager.transform(targetBody, transform)
-
-    return targetBody
+    # With no gap to the part (the default), the scale factor is 1 and the
+    # transformations would be no-ops, so we skip them entirely.
+    if gapToPart != 0:
+        scaleFactorX = (length + 2*gapToPart) / length
+        scaleFactorY = (width + 2*gapToPart) / width
+        scaleFactor = max(scaleFactorX, scaleFactorY)
+        transform = coordinateSystem.createLocalScaleTransform(scaleFactor)
+        for sliceBodies in toolBodies:
+            for sliceBody in sliceBodies:
+                temporaryBRepManager.transform(sliceBody, transform)
+
+    return toolBodies
+
+
+# Cache of coordinate systems, so repeated preview updates with unchanged
+# selections do not measure the overlap body again. The key contains the end
+# points of the direction and the revision ids of both bodies, so any edit
+# that can change the frame invalidates the entry. The cache is cleared once
+# it collects a handful of stale selections.
+_coordinateSystemCache = {}
+
+def getCoordinateSystem(inputs, overlap):
+    startPoint, endPoint = getDirectionEndPoints(inputs.direction)
+    key = (tuple(startPoint.asArray()), tuple(endPoint.asArray()),
+           inputs.body0.entityToken, inputs.body0.revisionId,
+           inputs.body1.entityToken, inputs.body1.revisionId)
+    coordinateSystem = _coordinateSystemCache.get(key)
+    if coordinateSystem is None:
+        if len(_coordinateSystemCache) >= 8:
+            _coordinateSystemCache.clear()
+        coordinateSystem = CoordinateSystem(inputs.direction, overlap)
+        _coordinateSystemCache[key] = coordinateSystem
+    return coordinateSystem
 
 
 def createBodyFromOverlap(body0, body1):
-    temporaryBRepManager = adsk.fusion.TemporaryBRepManager.get()
+    temporaryBRepManager = getTemporaryBRepManager()
     overlapBody = temporaryBRepManager.copy(body0)
     temporaryBRepManager.booleanOperation(overlapBody, body1, adsk.fusion.BooleanTypes.IntersectionBooleanType)
     return overlapBody
 
 
 def createToolBodies(inputs):
+    """Creates the tool bodies used to cut the fingers and notches.
+
+    Returns two lists of bodies (one for each cut) or None if no cut is
+    necessary (the bodies do not overlap). Raises InvalidInputsError if no
+    cut is possible (e.g., because of invalid inputs)."""
+    # If even the axis-aligned bounding boxes do not intersect, the bodies
+    # cannot overlap and we can skip the expensive boolean intersection.
+    if not inputs.body0.boundingBox.intersects(inputs.body1.boundingBox):
+        return None
     overlap = createBodyFromOverlap(inputs.body0, inputs.body1)
-    coordinateSystem = CoordinateSystem(inputs.direction, overlap)
-    coordinateSystem.transformToLocalCoordinates(overlap)
-    # TODO: look at MeasureManager.getOrientedBoundingBox to see if this can be simplified, probably with direction.geometry/worldGeometry
-
-    bb = overlap.boundingBox
-    height = bb.maxPoint.z - bb.minPoint.z
+    coordinateSystem = getCoordinateSystem(inputs, overlap)
+    height = coordinateSystem.localHeight
     if height <= 0:
-        return True
+        return None
     fingerDimensions, notchDimensions = defineToolBodyDimensions(height, inputs)
     if fingerDimensions is None or notchDimensions is None:
-        return False
+        raise InvalidInputsError()
+    # A tool without slices cannot cut anything, so bail out before doing any
+    # BRep work for either tool.
+    if not fingerDimensions[0] or not notchDimensions[0]:
+        raise InvalidInputsError()
 
-    fingerToolBody = createToolBody(overlap, fingerDimensions, inputs)
-    coordinateSystem.transformToGlobalCoordinates(fingerToolBody)
-    notchToolBody = createToolBody(overlap, notchDimensions, inputs)
-    coordinateSystem.transformToGlobalCoordinates(notchToolBody)
-    return fingerToolBody, notchToolBody
+    fingerToolBodies, notchToolBodies = createToolBody(overlap, [fingerDimensions, notchDimensions], inputs, coordinateSystem)
+    if not fingerToolBodies or not notchToolBodies:
+        raise InvalidInputsError()
+    return fingerToolBodies, notchToolBodies
 
 
 def defineToolBodyDimensions(size, inputs):
@@ -190,10 +309,10 @@ def defineToolBodyDimensions(size, inputs):
             # Across the size of the piece, we have to distribute F fingers, N notches and (F + N - 1) gaps.
             # The gaps have a fixed size g and we get size = (F + N) * w + (F + N - 1) * g. Solving for (F + N) gives
             # the formula to calculate the maximal number of fingers and notches we can place.
-            maxNumFingersAndNotches = int((size + gapSize) / (minFingerSize + gapSize))
+            maxNumFingersAndNotches = int((size + gapSize) // (minFingerSize + gapSize))
             # If there are the same number of fingers and notches the number needs to be even, otherwise odd.
             # We treat the number as even (rounding down) and correct when the number was odd.
-            numFingers = numNotches = int(maxNumFingersAndNotches / 2)
+            numFingers = numNotches = maxNumFingersAndNotches // 2
             if placementType == PlacementType.FINGERS_OUTSIDE:
                 if maxNumFingersAndNotches % 2 == 1:
                     numFingers += 1
@@ -226,7 +345,7 @@ def defineToolBodyDimensions(size, inputs):
             # Assuming we have F fingers of width f, N = F + x notches of width n, and G = (F + N - 1) gaps
             # of width g, the total size is size = F*f + (F+x)*n + (2F+x-1)*g.
             # Solving for F gives the number of fingers (rounding down because we used the minimal size for fingers).
-            numFingers = int((size - extraNotch*(notchSize + gapSize) + gapSize) / (notchSize + minFingerSize + 2 * gapSize))
+            numFingers = int((size - extraNotch*(notchSize + gapSize) + gapSize) // (notchSize + minFingerSize + 2 * gapSize))
             numNotches = numFingers + extraNotch
             if numFingers == 0:
                 return None, None
@@ -247,7 +366,7 @@ def defineToolBodyDimensions(size, inputs):
             # Assuming we have N notches of width n, F = N + x fingers of width f, and G = (F + N - 1) gaps
             # of width g, the total size is size = (N+x)*f + N*n + (2N+x-1)*g.
             # Solving for N gives the number of notches (rounding down because we used the minimal size for notches).
-            numNotches = int((size - extraFinger*(fingerSize + gapSize) + gapSize) / (fingerSize + minNotchSize + 2 * gapSize))
+            numNotches = int((size - extraFinger*(fingerSize + gapSize) + gapSize) // (fingerSize + minNotchSize + 2 * gapSize))
             numFingers = numNotches + extraFinger
             if numNotches == 0:
                 return None, None
@@ -274,10 +393,12 @@ def defineToolBodyDimensions(size, inputs):
         notchStart = 0
 
     # The tool bodies contain the full gap on both sides of the finger/notch.
+    # All slices of a tool have the same thickness, so each tool is described
+    # by its slice start positions plus a single thickness.
     spacing = fingerSize + notchSize + 2 * gapSize
 
     # The tool for cutting fingers consists of all places where there are notches or gaps (everything other than a finger).
-    fingerToolDimensions = [(notchStart + i*spacing - gapSize, notchSize + 2 * gapSize) for i in range(numNotches)]
+    fingerToolDimensions = ([notchStart + i*spacing - gapSize for i in range(numNotches)], notchSize + 2 * gapSize)
     # The tool for cutting notches consists of all places where there are fingers or gaps (everything other than a notch).
-    notchToolDimensions = [(fingerStart + i*spacing - gapSize, fingerSize + 2 * gapSize) for i in range(numFingers)]
+    notchToolDimensions = ([fingerStart + i*spacing - gapSize for i in range(numFingers)], fingerSize + 2 * gapSize)
     return fingerToolDimensions, notchToolDimensions
@@ -1,8 +1,7 @@
 import json
 import os
 
-import adsk.core
-
+from . import application
 from . import ui
 
 APP_PATH = os.path.dirname(os.path.abspath(__file__))
@@ -18,9 +17,17 @@ class PlacementType:
     SAME_NUMBER_START_FINGER = 'same number of fingers and notches (start with finger)'
     SAME_NUMBER_START_NOTCH = 'same number of fingers and notches (start with notch)'
 
+# Marks an expression as not yet evaluated (None is a possible result, so we
+# need a separate sentinel).
+_UNEVALUATED = object()
+
 class FusionExpression(object):
+    __slots__ = ('_expression', '_cachedValue', '_cachedIsValid')
+
     def __init__(self, expression):
         self._expression = expression
+        self._cachedValue = _UNEVALUATED
+        self._cachedIsValid = _UNEVALUATED
 
     @property
     def expression(self):
@@ -29,16 +36,26 @@ class FusionExpression(object):
     @expression.setter
     def expression(self, value):
         self._expression = value
+        self._cachedValue = _UNEVALUATED
+        self._cachedIsValid = _UNEVALUATED
 
+    # Evaluating an expression is a round trip into Fusion's units manager,
+    # so both properties cache their result until the expression changes.
+    # Expression objects only live within one command invocation, so the
+    # document units cannot change under the cache.
     @property
     def value(self):
-        unitsManager = adsk.core.Application.get().activeProduct.unitsManager
-        return unitsManager.evaluateExpression(self._expression)
+        if self._cachedValue is _UNEVALUATED:
+            unitsManager = application.get().activeProduct.unitsManager
+            self._cachedValue = unitsManager.evaluateExpression(self._expression)
+        return self._cachedValue
 
     @property
     def isValid(self):
-        unitsManager = adsk.core.Application.get().activeProduct.unitsManager
-        return unitsManager.isValidExpression(self._expression, unitsManager.defaultLengthUnits)
+        if self._cachedIsValid is _UNEVALUATED:
+            unitsManager = application.get().activeProduct.unitsManager
+            self._cachedIsValid = unitsManager.isValidExpression(self._expression, unitsManager.defaultLengthUnits)
+        return self._cachedIsValid
 
 
 # Fusion distinguishes three types of parameters:
@@ -48,7 +65,26 @@ class FusionExpression(object):
 # We want to keep track of all of them and store default values for values and settings.
 class FingerJointFeatureInput(object):
     DEFAULTS_FILENAME = os.path.join(APP_PATH, 'defaults.json')
+    # Class-level cache of the parsed defaults file. An options object is
+    # constructed for every command invocation, so we only re-read the file
+    # when it changed on disk (DEFAULTS_MTIME is its modification time).
     DEFAULTS_DATA = {}
+    DEFAULTS_MTIME = None
+
+    # Fields stored in the defaults file, split by how they are read back:
+    # simple fields are used as-is, expression fields are validated and
+    # wrapped in a FusionExpression.
+    SIMPLE_FIELDS = ('dynamicSizeType', 'placementType',
+                     'isNumberOfFingersFixed', 'fixedNumFingers',
+                     'isPreviewEnabled')
+    EXPRESSION_FIELDS = ('fixedFingerSize', 'fixedNotchSize', 'minFingerSize',
+                         'minNotchSize', 'gap', 'gapToPart')
+
+    __slots__ = ('body0', 'body1', 'direction', 'dynamicSizeType',
+                 'placementType', 'isNumberOfFingersFixed', 'fixedFingerSize',
+                 'fixedNotchSize', 'minFingerSize', 'minNotchSize',
+                 'fixedNumFingers', 'gap', 'gapToPart', 'isPreviewEnabled',
+                 '_loadedState')
 
     def __init__(self):
         # Entities
@@ -69,23 +105,43 @@ class FingerJointFeatureInput(object):
         self.gapToPart = FusionExpression("0 mm")
         self.isPreviewEnabled = True
         self.readDefaults()
+        # Remember what we loaded, so writeDefaults can skip the file write
+        # if nothing changed.
+        self._loadedState = self._currentState()
+
+    def signature(self):
+        """Returns the settings and values as a hashable tuple.
+
+        Two inputs with the same signature describe the same joint geometry
+        (up to the selected entities), so the tuple can serve as a cache key."""
+        return (self.dynamicSizeType,
+                self.placementType,
+                self.isNumberOfFingersFixed,
+                self.fixedFingerSize.expression,
+                self.fixedNotchSize.expression,
+                self.minFingerSize.expression,
+                self.minNotchSize.expression,
+                self.fixedNumFingers,
+                self.gap.expression,
+                self.gapToPart.expression)
+
+    def _currentState(self):
+        return self.signature() + (self.isPreviewEnabled,)
 
     def writeDefaults(self):
-        defaultData = {
-            'dynamicSizeType': self.dynamicSizeType,
-            'placementType': self.placementType,
-            'isNumberOfFingersFixed': self.isNumberOfFingersFixed,
-            'fixedFingerSize': self.fixedFingerSize.expression,
-            'fixedNotchSize': self.fixedNotchSize.expression,
-            'minFingerSize': self.minFingerSize.expression,
-            'minNotchSize': self.minNotchSize.expression,
-            'fixedNumFingers': self.fixedNumFingers,
-            'gap': self.gap.expression,
-            'gapToPart': self.gapToPart.expression,
-            'isPreviewEnabled': self.isPreviewEnabled,
-        }
+        if self._currentState() == self._loadedState:
+            return
+        defaultData = {name: getattr(self, name) for name in self.SIMPLE_FIELDS}
+        for name in self.EXPRESSION_FIELDS:
+            defaultData[name] = getattr(self, name).expression
         with open(self.DEFAULTS_FILENAME, 'w', encoding='UTF-8') as json_file:
             json.dump(defaultData, json_file, ensure_ascii=False)
+        self._loadedState = self._currentState()
+        # Refresh the cache, so the next readDefaults does not have to parse
+        # the file we just wrote.
+        cls = FingerJointFeatureInput
+        cls.DEFAULTS_DATA = defaultData
+        cls.DEFAULTS_MTIME = os.stat(self.DEFAULTS_FILENAME).st_mtime_ns
     
     def readDefaults(self):
         def expressionOrDefault(value, default):
@@ -95,23 +151,23 @@ class FingerJointFeatureInput(object):
             else:
                 return default
 
-        if not os.path.isfile(self.DEFAULTS_FILENAME):
+        try:
+            mtime = os.stat(self.DEFAULTS_FILENAME).st_mtime_ns
+        except OSError:
             return
-        with open(self.DEFAULTS_FILENAME, 'r', encoding='UTF-8') as json_file:
-            try:
-                defaultData = json.load(json_file)
-            except ValueError:
-                ui.reportError('Cannot read default options. Invalid JSON in "%s":' % self.DEFAULTS_FILENAME)
-
-        self.dynamicSizeType = defaultData.get('dynamicSizeType', self.dynamicSizeType)
-        self.placementType = defaultData.get('placementType', self.placementType)
-        self.isNumberOfFingersFixed = defaultData.get('isNumberOfFingersFixed', self.isNumberOfFingersFixed)
-        self.fixedFingerSize = expressionOrDefault(defaultData.get('fixedFingerSize'), self.fixedFingerSize)
-        self.fixedNotchSize = expressionOrDefault(defaultData.get('fixedNotchSize'), self.fixedNotchSize)
-        self.minFingerSize = expressionOrDefault(defaultData.get('minFingerSize'), self.minFingerSize)
-        self.minNotchSize = expressionOrDefault(defaultData.get('minNotchSize'), self.minNotchSize)
-        self.fixedNumFingers = defaultData.get('fixedNumFingers', self.fixedNumFingers)
-        self.gap = expressionOrDefault(defaultData.get('gap'), self.gap)
-        self.gapToPart = expressionOrDefault(defaultData.get('gapToPart'), self.gapToPart)
-        self.isPreviewEnabled = defaultData.get('isPreviewEnabled', self.isPreviewEnabled)
+        cls = FingerJointFeatureInput
+        if mtime != cls.DEFAULTS_MTIME:
+            with open(self.DEFAULTS_FILENAME, 'r', encoding='UTF-8') as json_file:
+                try:
+                    cls.DEFAULTS_DATA = json.load(json_file)
+                except ValueError:
+                    ui.reportError('Cannot read default options. Invalid JSON in "%s":' % self.DEFAULTS_FILENAME)
+                    cls.DEFAULTS_DATA = {}
+            cls.DEFAULTS_MTIME = mtime
+        defaultData = cls.DEFAULTS_DATA
+
+        for name in self.SIMPLE_FIELDS:
+            setattr(self, name, defaultData.get(name, getattr(self, name)))
+        for name in self.EXPRESSION_FIELDS:
+            setattr(self, name, expressionOrDefault(defaultData.get(name), getattr(self, name)))
 
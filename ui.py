@@ -1,17 +1,34 @@
-import traceback
-
 import adsk.core
 
+from . import application
 from .options import FingerJointFeatureInput, PlacementType, DynamicSizeType, FusionExpression
 
 class FingerJointUI(object):
+    # Mappings from the selected item index of the button rows/drop downs to
+    # the option values. The order has to match the order in which the list
+    # items are added in __init__. Class-level tuples, so the dialog does not
+    # allocate fresh lists every time it opens.
+    _placementTypesByIndex = (
+        PlacementType.FINGERS_OUTSIDE,
+        PlacementType.NOTCHES_OUTSIDE,
+        PlacementType.SAME_NUMBER_START_FINGER,
+        PlacementType.SAME_NUMBER_START_NOTCH,
+    )
+    _numberOfFingersFixedByIndex = (True, False)
+    _dynamicSizeTypesByIndex = (
+        DynamicSizeType.FIXED_NOTCH_SIZE,
+        DynamicSizeType.FIXED_FINGER_SIZE,
+        DynamicSizeType.EQUAL_NOTCH_AND_FINGER_SIZE,
+    )
+
+    # Formatted variants of the error messages, built once per distinct
+    # message (there are only a handful of them, all constant).
+    _formattedErrorMessages = {}
+
     def __init__(self, inputs, defaults):
-        app = adsk.core.Application.get()
-        unitsManager = app.activeProduct.unitsManager
+        unitsManager = application.get().activeProduct.unitsManager
         defaultUnit = unitsManager.defaultLengthUnits
 
-        self._inputs = inputs
-
         self._inputBody0 = inputs.addSelectionInput(
             'inputBody0', 'First Body',
             'Select the body that should contain the first finger.')
@@ -36,25 +53,24 @@ class FingerJointUI(object):
         self._inputDirection.addSelectionFilter('SketchLines')
         self._inputDirection.setSelectionLimits(1,1)
 
+        # The selection inputs in the order they should receive focus. Known
+        # statically, so focusNextSelectionInput does not have to scan all
+        # command inputs for their type.
+        self._selectionInputs = (self._inputBody0, self._inputBody1,
+                                 self._inputDirection)
+
         self._inputPlacementType = inputs.addButtonRowCommandInput('inputPlacementType', 'Finger Placement', False)
         self._inputPlacementType.listItems.add('Fingers outside', defaults.placementType == PlacementType.FINGERS_OUTSIDE, 'resources/ui/placement_fingers_outside' )
         self._inputPlacementType.listItems.add('Notches outside', defaults.placementType == PlacementType.NOTCHES_OUTSIDE, 'resources/ui/placement_notches_outside' )
         self._inputPlacementType.listItems.add('Start with finger, end with notch', defaults.placementType == PlacementType.SAME_NUMBER_START_FINGER, 'resources/ui/placement_same_number_start_finger' )
         self._inputPlacementType.listItems.add('Start with notch, end with finger', defaults.placementType == PlacementType.SAME_NUMBER_START_NOTCH, 'resources/ui/placement_same_number_start_notch' )
         self._inputPlacementType.tooltipDescription = "Should the first selected body start/end with a finger or a notch?"
-        self._placementTypesByIndex = [
-             PlacementType.FINGERS_OUTSIDE,
-             PlacementType.NOTCHES_OUTSIDE,
-             PlacementType.SAME_NUMBER_START_FINGER,
-             PlacementType.SAME_NUMBER_START_NOTCH
-        ]
 
         self._inputIsNumberOfFingersFixed = inputs.addDropDownCommandInput('inputIsNumberOfFingersFixed', 'Number', adsk.core.DropDownStyles.LabeledIconDropDownStyle)
         self._inputIsNumberOfFingersFixed.tooltipDescription = "Should the number of fingers be a fixed number or determined from the size of fingers/notches and the size of the overlap?"
         dropdownItems = self._inputIsNumberOfFingersFixed.listItems
         dropdownItems.add('Fixed', defaults.isNumberOfFingersFixed, 'resources/ui/finger_number_fixed')
         dropdownItems.add('Dynamic', not defaults.isNumberOfFingersFixed, 'resources/ui/finger_number_dynamic')
-        self._numberOfFingersFixedByIndex = [True, False]
 
         # Looks like a spinner has to have a maximum but 100000 seems reasonable. Creating that much fingers will likely run into memory or performance issues anyway.
         self._inputFixedNumFingers = inputs.addIntegerSpinnerCommandInput('inputFixedNumFingers', 'Number of Fingers', 1 , 100000 , 1, defaults.fixedNumFingers)
@@ -64,11 +80,6 @@ class FingerJointUI(object):
         self._inputDynamicSizeType.listItems.add('Fixed Finger Size', defaults.dynamicSizeType == DynamicSizeType.FIXED_FINGER_SIZE, 'resources/ui/dynamic_type_fixed_finger' )
         self._inputDynamicSizeType.listItems.add('Equal Notch and Finger Size', defaults.dynamicSizeType == DynamicSizeType.EQUAL_NOTCH_AND_FINGER_SIZE, 'resources/ui/dynamic_type_equal_notch_and_finger' )
         self._inputDynamicSizeType.tooltipDescription = "Should notches or fingers have a fixed size or should their size be equally distributed over the length of the overlap?"
-        self._dynamicSizeTypesByIndex = [
-             DynamicSizeType.FIXED_NOTCH_SIZE,
-             DynamicSizeType.FIXED_FINGER_SIZE,
-             DynamicSizeType.EQUAL_NOTCH_AND_FINGER_SIZE,
-        ]
 
         defaultNotchSize = adsk.core.ValueInput.createByString(defaults.fixedNotchSize.expression)
         self._inputFixedNotchSize = inputs.addValueInput('inputFixedNotchSize', 'Notch Size', defaultUnit, defaultNotchSize)
@@ -92,6 +103,8 @@ class FingerJointUI(object):
 
         self._inputErrorMessage = inputs.addTextBoxCommandInput('inputErrorMessage', '', '', 3, True)
         self._inputErrorMessage.isFullWidth = True
+        self._lastErrorMessage = ''
+        self._visibilityState = None
 
         self.updateVisibility()
         self.focusNextSelectionInput()
@@ -105,6 +118,14 @@ class FingerJointUI(object):
     def updateVisibility(self):
         dynamicSizeType = self.getDynamicSizeType()
         numberOfFingersFixed = self.isNumberOfFingersFixed()
+        # The visibility only depends on these two settings. Assigning
+        # isVisible triggers a UI update in Fusion even when the value does
+        # not change, so we skip the writes if the settings are unchanged
+        # (the usual case when the user edits a numeric input).
+        state = (dynamicSizeType, numberOfFingersFixed)
+        if state == self._visibilityState:
+            return
+        self._visibilityState = state
         self._inputFixedNotchSize.isVisible = dynamicSizeType == DynamicSizeType.FIXED_NOTCH_SIZE
         self._inputFixedFingerSize.isVisible = dynamicSizeType == DynamicSizeType.FIXED_FINGER_SIZE
         self._inputFixedNumFingers.isVisible = numberOfFingersFixed
@@ -161,20 +182,26 @@ class FingerJointUI(object):
         # We guard this statement to prevent an infinite loop of setting
         # the value, validating the input because an input changed, computing
         # the preview because the validation was successfull, and setting the
-        #  value to '' there.
-        # Unfortunately, setting the formatted value to x doesn't mean that the
-        # value is x afterwards  (e.g., '' is turned into '<br />').
+        # value to '' there.
+        # The last message is tracked on the Python side because reading the
+        # value back from Fusion does not return what was written (e.g., ''
+        # is turned into '<br />'). This also makes the common case of an
+        # unchanged message free of API calls.
+        if msg == self._lastErrorMessage:
+            return
+        self._lastErrorMessage = msg
         if msg:
-            formattedText = '<p style="color:red">{}</p>'.format(msg)
-            if self._inputErrorMessage.formattedText != formattedText:
-                self._inputErrorMessage.formattedText = formattedText
+            formattedText = self._formattedErrorMessages.get(msg)
+            if formattedText is None:
+                formattedText = '<p style="color:red">{}</p>'.format(msg)
+                self._formattedErrorMessages[msg] = formattedText
+            self._inputErrorMessage.formattedText = formattedText
         else:
-            if self._inputErrorMessage.text != '':
-                self._inputErrorMessage.text = ''
+            self._inputErrorMessage.text = ''
 
     def focusNextSelectionInput(self):
-        for input in self._inputs:
-            if isinstance(input, adsk.core.SelectionCommandInput) and input.selectionCount == 0:
+        for input in self._selectionInputs:
+            if input.selectionCount == 0:
                 input.hasFocus = True
                 break
 
@@ -187,16 +214,23 @@ class FingerJointUI(object):
         inputs.placementType = self.getPlacementType()
         inputs.isNumberOfFingersFixed = self.isNumberOfFingersFixed()
         # Only update the options that are relevant for the current operation.
-        if self.getFixedNumFingers() is not None:
-            inputs.fixedNumFingers = self.getFixedNumFingers()
-        if self.getFixedNotchSize() is not None:
-            inputs.fixedNotchSize = self.getFixedNotchSize()
-        if self.getFixedFingerSize() is not None:
-            inputs.fixedFingerSize = self.getFixedFingerSize()
-        if self.getMinNotchSize() is not None:
-            inputs.minNotchSize = self.getMinNotchSize()
-        if self.getMinFingerSize() is not None:
-            inputs.minFingerSize = self.getMinFingerSize()
+        # Each getter goes through the Fusion inputs, so we call each one only
+        # once.
+        fixedNumFingers = self.getFixedNumFingers()
+        if fixedNumFingers is not None:
+            inputs.fixedNumFingers = fixedNumFingers
+        fixedNotchSize = self.getFixedNotchSize()
+        if fixedNotchSize is not None:
+            inputs.fixedNotchSize = fixedNotchSize
+        fixedFingerSize = self.getFixedFingerSize()
+        if fixedFingerSize is not None:
+            inputs.fixedFingerSize = fixedFingerSize
+        minNotchSize = self.getMinNotchSize()
+        if minNotchSize is not None:
+            inputs.minNotchSize = minNotchSize
+        minFingerSize = self.getMinFingerSize()
+        if minFingerSize is not None:
+            inputs.minFingerSize = minFingerSize
         inputs.gap = self.getGap()
         inputs.gapToPart = self.getGapToPart()
         inputs.isPreviewEnabled = self.isPreviewEnabled()
@@ -208,21 +242,28 @@ class FingerJointUI(object):
         if self.getPlacementType() == PlacementType.FINGERS_OUTSIDE and self.isNumberOfFingersFixed() and self.getFixedNumFingers() < 2:
             valid = False
             errorMessage = 'When using one finger on each edge, there have to be at least two fingers.'
-        if self._inputFixedNotchSize.isVisible and (self.getFixedNotchSize() is None or self.getFixedNotchSize().value <= 0):
-            valid = False
-        if self._inputFixedFingerSize.isVisible and (self.getFixedFingerSize() is None or self.getFixedFingerSize().value <= 0):
-            valid = False
-        if self._inputMinNotchSize.isVisible and (self.getMinNotchSize() is None or self.getMinNotchSize().value <= 0):
-            valid = False
-        if self._inputMinFingerSize.isVisible and (self.getMinFingerSize() is None or self.getMinFingerSize().value <= 0):
-            valid = False
+        # The getters return None for hidden inputs as well as for invalid
+        # expressions; only the latter should invalidate the inputs, so the
+        # visibility is only checked when the expression is missing.
+        for input, expression in (
+                (self._inputFixedNotchSize, self.getFixedNotchSize()),
+                (self._inputFixedFingerSize, self.getFixedFingerSize()),
+                (self._inputMinNotchSize, self.getMinNotchSize()),
+                (self._inputMinFingerSize, self.getMinFingerSize())):
+            if expression is None:
+                if input.isVisible:
+                    valid = False
+            elif expression.value <= 0:
+                valid = False
         self.setInputErrorMessage(errorMessage)
         return valid
 
 
 def reportError(message, includeStacktrace=False):
-    fusion = adsk.core.Application.get()
-    fusionUI = fusion.userInterface
+    fusionUI = application.userInterface()
     if includeStacktrace:
+        # Only needed on error paths, so we do not pay for the import when
+        # the add-in loads.
+        import traceback
         message = '{}\n\nStack trace:\n{}'.format(message, traceback.format_exc())
     fusionUI.messageBox(message)